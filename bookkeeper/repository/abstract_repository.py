@@ -30,6 +30,7 @@ class AbstractRepository(ABC, Generic[T]):
     get_all
     update
     delete
+    Метод add_many по умолчанию добавляет объекты по одному через add.
     """
 
     @abstractmethod
@@ -39,6 +40,13 @@ class AbstractRepository(ABC, Generic[T]):
         также записать id в атрибут pk.
         """
 
+    def add_many(self, objs: list[T]) -> list[int]:
+        """
+        Добавить в репозиторий несколько объектов, вернуть список их id,
+        также записать id в атрибут pk каждого объекта.
+        """
+        return [self.add(obj) for obj in objs]
+
     @abstractmethod
     def get(self, pk: int) -> T | None:
         """ Получить объект по id """
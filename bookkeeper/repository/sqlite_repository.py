@@ -2,143 +2,534 @@
 Модуль, описывающий репозиторий для работы с SQLite
 """
 
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from inspect import get_annotations
-from typing import Any, get_args
-from types import UnionType
-from datetime import datetime, date
+from operator import attrgetter
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Union, get_args, get_origin
+from types import NoneType, UnionType
+from datetime import datetime, date, timedelta, timezone
 
 from bookkeeper.repository.abstract_repository import AbstractRepository, T
 
+logger = logging.getLogger(__name__)
 
+MEMORY_DB = ':memory:'
+CACHED_STATEMENTS = 256
+FETCH_SIZE = 1000
+READER_POOL_SIZE = 4
+# INSERT ... RETURNING поддерживается начиная с SQLite 3.35
+INSERT_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -131072',
+    'PRAGMA mmap_size = 1073741824',
+    'PRAGMA foreign_keys = ON',
+)
+
+# Таблицы (файл базы, имя таблицы, индексируемые поля), для которых
+# в этом процессе уже выполнено создание схемы
+_ENSURED: set[tuple[str, str, tuple[str, ...]]] = set()
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+# Дробная часть секунд в тексте ISO 8601: цифры после точки в 20-й позиции
+# до смещения часового пояса (+, - или Z), дополненные нулями до шести
+FRACTION = "CASE WHEN substr({0}, 20, 1) = '.' THEN CAST(substr(substr(" \
+    "substr({0}, 21) || 'Z', 1, min(" \
+    "coalesce(nullif(instr(substr({0}, 21), '+'), 0), 99), " \
+    "coalesce(nullif(instr(substr({0}, 21), '-'), 0), 99), " \
+    "instr(substr({0}, 21) || 'Z', 'Z')) - 1) || '000000', 1, 6) AS INTEGER) " \
+    "ELSE 0 END"
+# Шаблон текста ISO 8601: уже переведённые числа, сохранённые в столбцах
+# с текстовым типом, ему не соответствуют и повторно не переводятся
+ISO_DATE = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+# Выражения для перевода дат, сохранённых старыми версиями в виде текста
+# ISO 8601, в целочисленное представление. Время со смещением приводится
+# к UTC. Текст, который SQLite не может разобрать, остаётся без изменений.
+TEXT_TO_INTEGER = {
+    datetime: "CAST(strftime('%s', {0}) AS INTEGER) * 1000000 + " + FRACTION,
+    date: "CAST(julianday({0}) - 1721424.5 AS INTEGER)",
+}
+
+
+def _datetime_to_db(value: datetime) -> int:
+    """
+    Время хранится как число микросекунд от начала эпохи Unix,
+    время с часовым поясом предварительно приводится к UTC
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // MICROSECOND
+
+
+def _datetime_from_db(value: bytes) -> datetime:
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def _date_from_db(value: bytes) -> date:
+    return date.fromordinal(int(value))
+
+
+def _date_to_db(value: date) -> int:
+    """ Дата хранится как порядковый номер дня (date.toordinal) """
+    return value.toordinal()
+
+
+# Преобразователи при чтении указываются в запросах по имени в названии
+# столбца (PARSE_COLNAMES), а не по объявленному типу: в таблицах, созданных
+# старыми версиями, даты и время объявлены одинаково
+sqlite3.register_converter('bookkeeper_datetime', _datetime_from_db)
+sqlite3.register_converter('bookkeeper_date', _date_from_db)
+
+
+# pylint: disable-next=too-many-instance-attributes
 class SQLiteRepository(AbstractRepository[T]):
     """
     Основной репозиторий для работы с SQLite.
+    Держит одно долгоживущее соединение для записи на всё время жизни
+    репозитория, доступ к нему из разных потоков сериализуется блокировкой.
+    Чтение из файловой базы идёт через пул соединений только для чтения,
+    которые в режиме WAL не блокируются записью. База в памяти доступна
+    только своему соединению, поэтому для неё чтение идёт через
+    соединение для записи.
     """
 
-    def __init__(self, db_file: str, cls: type) -> None:
+    def __init__(self, db_file: str, cls: type,
+                 indexed_fields: Iterable[str] = ()) -> None:
         self.db_file = db_file
         self.table_name = cls.__name__.lower()
         self.fields = get_annotations(cls, eval_str=True)
         self.fields.pop('pk')
+        self.indexed_fields = tuple(sorted(set(indexed_fields)))
+        for field in self.indexed_fields:
+            if field not in self.fields:
+                raise ValueError(f'Cannot index unknown field `{field}`')
         self.cls = cls
+        adapters = {name: self._resolve_adapter(field_type)
+                    for name, field_type in self.fields.items()}
+        self._adapters: dict[str, Callable[[Any], Any]] = {
+            name: adapt for name, adapt in adapters.items() if adapt is not None}
+        self._row_factory = self._compile_row_factory()
+        self._getter = attrgetter(*self.fields)
         names = ', '.join(self.fields.keys())
+        columns = ', '.join(self._select_column(name, field_type)
+                            for name, field_type in self.fields.items())
         placeholders = ', '.join("?" * len(self.fields))
         fields_update = ", ".join([f"{field}=?" for field in self.fields.keys()])
         self.queries = {
-            'foreign_keys': 'PRAGMA foreign_keys = ON',
-            'add': f'INSERT INTO {self.table_name} ({names}) VALUES ({placeholders})',
-            'get': f'SELECT pk, {names} FROM {self.table_name} WHERE pk = ?',
-            'get_all': f'SELECT pk, {names}  FROM {self.table_name}',
+            'add': f'INSERT INTO {self.table_name} ({names}) VALUES ({placeholders})'
+                   + (' RETURNING pk' if INSERT_RETURNING else ''),
+            'get': f'SELECT pk, {columns} FROM {self.table_name} WHERE pk = ?',
+            'get_all': f'SELECT pk, {columns} FROM {self.table_name}',
             'update': f'UPDATE {self.table_name} SET {fields_update} WHERE pk = ?',
             'delete': f'DELETE FROM {self.table_name} WHERE pk = ?',
         }
-        types_for_table = [f"{name} {self._resolve_type(type)}"
-                           for name, type in self.fields.items()]
-        create_table = f'CREATE TABLE IF NOT EXISTS {self.table_name} (' \
-            + f'{", ".join(types_for_table)}, pk INTEGER PRIMARY KEY )'
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            cur.execute(self.queries['foreign_keys'])
-            cur.execute(create_table)
+        self._lock = threading.Lock()
+        self._where_queries: dict[tuple[str, ...], str] = {}
+        self._in_memory = self.db_file in ('', MEMORY_DB)
+        # Путь к файлу базы определяется один раз, чтобы смена текущего
+        # каталога не влияла на соединения, открываемые позже
+        path = Path(self.db_file).absolute()
+        self._db_path = self.db_file if self._in_memory else str(path)
+        self._reader_uri = path.as_uri() + '?mode=ro'
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue(READER_POOL_SIZE)
+        self._con = self._connect()
+        self._closed = False
+        try:
+            if self._in_memory:
+                self._create_schema()
+            else:
+                key = (self._db_path, self.table_name, self.indexed_fields)
+                if key not in _ENSURED:
+                    self._create_schema()
+                    self._warm_up()
+                    _ENSURED.add(key)
+        except BaseException:
+            self._con.close()
+            raise
+        atexit.register(self.close)
+
+    @classmethod
+    def ensure_schema(cls, db_file: str, model: type,
+                      indexed_fields: Iterable[str] = ()) -> None:
+        """
+        Создать таблицу для модели model в базе db_file, если её ещё нет,
+        и индексы по полям indexed_fields.
+        Достаточно вызвать один раз при запуске приложения: в пределах
+        процесса схема для каждой пары (файл, таблица) проверяется
+        только один раз, последующие репозитории её не пересоздают.
+        """
+        cls(db_file, model, indexed_fields).close()
 
     def add(self, obj: T) -> int:
         if getattr(obj, 'pk', None) != 0:
             raise ValueError(f'Trying to add object {obj} with filled `pk` attribute')
 
-        values = [getattr(obj, x) for x in self.fields]
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            cur.execute(self.queries['foreign_keys'])
-            cur.execute(self.queries['add'], values)
-
-            if cur.lastrowid is not None:
-                obj.pk = cur.lastrowid
+        values = self._values(obj)
+        with self._cursor() as cur:
+            obj.pk = self._insert(cur, values)
 
         return obj.pk
 
-    def get(self, pk: int) -> T | None:
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            row = cur.execute(self.queries['get'], [pk]).fetchone()
+    def add_many(self, objs: list[T]) -> list[int]:
+        for obj in objs:
+            if getattr(obj, 'pk', None) != 0:
+                raise ValueError(f'Trying to add object {obj} with filled `pk` attribute')
 
-        if row is None:
-            return None
+        pks = []
+        with self._transaction() as cur:
+            for obj in objs:
+                pks.append(self._insert(cur, self._values(obj)))
 
-        return self._generate_object(row)
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+        return pks
 
-    def get_all(self, where: dict[str, Any] | None = None) -> list[T]:
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            base = self.queries['get_all']
-
-            if where is not None:
-                conditions = " AND ".join([f"{field} = ?" for field in where.keys()])
-                rows = cur.execute(
-                    base + f' WHERE {conditions}',
-                    list(where.values())
-                ).fetchall()
-            else:
-                rows = cur.execute(base).fetchall()
+    def get(self, pk: int) -> T | None:
+        with self._reader() as cur:
+            cur.row_factory = self._row_factory
+            obj: T | None = cur.execute(self.queries['get'], (pk,)).fetchone()
+        return obj
 
-        return [self._generate_object(row) for row in rows]
+    def get_all(self, where: dict[str, Any] | None = None) -> list[T]:
+        return list(self._iter_all(where))
 
     def update(self, obj: T) -> None:
         if getattr(obj, 'pk', None) is None:
             raise ValueError('Trying to update object without `pk` attribute')
 
-        values = [getattr(obj, x) for x in self.fields]
-        values.append(obj.pk)
+        values = (*self._values(obj), obj.pk)
 
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            cur.execute(self.queries['foreign_keys'])
+        with self._cursor() as cur:
             cur.execute(self.queries['update'], values)
             if cur.rowcount == 0:
                 raise ValueError('Trying to update object with unknown primary key')
 
     def delete(self, pk: int) -> None:
-        with sqlite3.connect(self.db_file) as con:
-            cur = con.cursor()
-            cur.execute(self.queries['foreign_keys'])
-            cur.execute(self.queries['delete'], [pk])
+        with self._cursor() as cur:
+            cur.execute(self.queries['delete'], (pk,))
             if cur.rowcount == 0:
                 raise ValueError('Trying to delete object with unknown primary key')
 
-    def _generate_object(self, values: list[Any]) -> T:
+    def close(self) -> None:
+        """
+        Закрыть соединения с базой данных, повторный вызов ничего не делает.
+        Перед закрытием SQLite обновляет статистику для планировщика запросов.
+        """
+        atexit.unregister(self.close)
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._con.execute('PRAGMA optimize')
+            finally:
+                self._con.close()
+                self._close_readers()
+
+    def _create_schema(self) -> None:
+        """
+        Вспомогательный метод, создающий таблицу с индексами и переводящий
+        в целые числа даты, сохранённые старыми версиями в виде текста.
+        Все операторы выполняются одним скриптом в одной транзакции.
+        """
+        types_for_table = [f"{name} {self._resolve_type(type)}"
+                           for name, type in self.fields.items()]
+        create_table = f'CREATE TABLE IF NOT EXISTS {self.table_name} (' \
+            + f'{", ".join(types_for_table)}, pk INTEGER PRIMARY KEY )'
+        field_types = {name: self._unwrap_optional(field_type)
+                       for name, field_type in self.fields.items()}
+        migrations = [f'UPDATE {self.table_name} '
+                      f'SET {name} = {TEXT_TO_INTEGER[field_type].format(name)} '
+                      f"WHERE typeof({name}) = 'text' AND {name} GLOB '{ISO_DATE}' "
+                      f'AND julianday({name}) IS NOT NULL'
+                      for name, field_type in field_types.items()
+                      if field_type in TEXT_TO_INTEGER]
+        create_indexes = [f'CREATE INDEX IF NOT EXISTS idx_{self.table_name}_{field} '
+                          f'ON {self.table_name} ({field})'
+                          for field in self.indexed_fields]
+        script = ';\n'.join(['BEGIN', create_table, *create_indexes,
+                             *migrations, 'COMMIT'])
+        with self._cursor() as cur:
+            try:
+                cur.executescript(script)
+            except BaseException:
+                if self._con.in_transaction:
+                    cur.execute('ROLLBACK')
+                raise
+
+    def _warm_up(self) -> None:
+        """
+        Вспомогательный метод, заранее читающий страницы таблицы, чтобы
+        они оказались в кэше страниц и отображённой в память области
+        """
+        with self._cursor() as cur:
+            cur.execute(f'SELECT count(*) FROM {self.table_name}').fetchone()
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """
+        Вспомогательный метод, открывающий и настраивающий соединение:
+        размер страницы, журнал WAL (для файловых баз), режим синхронизации,
+        размеры кэша и отображаемой в память области.
+        Соединение только для чтения открывается в режиме mode=ro
+        и дополнительно запрещает изменения через PRAGMA query_only.
+        Все PRAGMA передаются в SQLite одним скриптом.
+        """
+        if read_only:
+            con = sqlite3.connect(self._reader_uri, uri=True, check_same_thread=False,
+                                  isolation_level=None,
+                                  detect_types=sqlite3.PARSE_COLNAMES,
+                                  cached_statements=CACHED_STATEMENTS)
+            pragmas: tuple[str, ...] = ('PRAGMA query_only = ON', *PRAGMAS)
+        else:
+            con = sqlite3.connect(self._db_path, check_same_thread=False,
+                                  isolation_level=None,
+                                  detect_types=sqlite3.PARSE_COLNAMES,
+                                  cached_statements=CACHED_STATEMENTS)
+            # Размер страницы применяется только к новой базе,
+            # поэтому задаётся до перевода журнала в WAL и создания таблиц
+            journal = () if self._in_memory else ('PRAGMA journal_mode = WAL',)
+            pragmas = ('PRAGMA page_size = 8192', *journal, *PRAGMAS)
+        con.executescript(';\n'.join(pragmas))
+        return con
+
+    def _where_query(self, fields: tuple[str, ...]) -> str:
+        """
+        Вспомогательный метод, возвращающий запрос get_all с условием
+        по полям fields. Текст запроса для одного набора полей строится
+        один раз, чтобы SQLite брал готовый оператор из кэша соединения,
+        поэтому поля ожидаются в отсортированном порядке. При построении
+        запроса выводится предупреждение о полях без индекса.
+        """
+        query = self._where_queries.get(fields)
+        if query is None:
+            for field in fields:
+                if field != 'pk' and field not in self.indexed_fields:
+                    logger.warning('Condition on non-indexed field `%s` of table `%s` '
+                                   'requires a full table scan', field, self.table_name)
+            conditions = " AND ".join([f"{field} = ?" for field in fields])
+            query = self.queries['get_all'] + f' WHERE {conditions}'
+            self._where_queries[fields] = query
+        return query
+
+    @contextmanager
+    def _cursor(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Вспомогательный метод, выдающий курсор общего соединения.
+        Соединение захватывается на время работы с курсором,
+        после выхода курсор закрывается.
+        """
+        with self._lock:
+            cur = self._con.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Вспомогательный метод, выдающий курсор соединения для чтения.
+        Соединение берётся из пула (или открывается, если пул пуст)
+        и возвращается в пул после выхода.
+        """
+        if self._in_memory:
+            with self._cursor() as cur:
+                yield cur
+            return
+        con = self._checkout_reader()
+        cur = con.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            self._return_reader(con)
+
+    def _checkout_reader(self) -> sqlite3.Connection:
+        """ Взять соединение для чтения из пула """
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed repository.')
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            return self._connect(read_only=True)
+
+    def _return_reader(self, con: sqlite3.Connection) -> None:
+        """
+        Вернуть соединение для чтения в пул. Лишние соединения
+        и соединения, возвращённые после закрытия репозитория, закрываются.
+        """
+        if self._closed:
+            con.close()
+            return
+        try:
+            self._readers.put_nowait(con)
+        except queue.Full:
+            con.close()
+            return
+        if self._closed:
+            self._close_readers()
+
+    def _close_readers(self) -> None:
+        """ Закрыть все соединения для чтения, лежащие в пуле """
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Вспомогательный метод, выдающий курсор внутри явной транзакции.
+        Все изменения фиксируются одним COMMIT при выходе,
+        при исключении транзакция откатывается.
+        """
+        with self._cursor() as cur:
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                yield cur
+            except BaseException:
+                cur.execute('ROLLBACK')
+                raise
+            cur.execute('COMMIT')
+
+    def _iter_all(self, where: dict[str, Any] | None = None) -> Iterator[T]:
+        """
+        Вспомогательный метод, выдающий объекты по мере чтения из базы
+        пачками по FETCH_SIZE строк. Соединение занято, пока генератор
+        не исчерпан или не закрыт.
+        """
+        if where is None:
+            query, params = self.queries['get_all'], ()
+        else:
+            fields = tuple(sorted(where))
+            query = self._where_query(fields)
+            params = tuple(self._adapt(field, where[field]) for field in fields)
+        with self._reader() as cur:
+            cur.row_factory = self._row_factory
+            cur.arraysize = FETCH_SIZE
+            cur.execute(query, params)
+            while rows := cur.fetchmany():
+                yield from rows
+
+    def _insert(self, cur: sqlite3.Cursor, values: tuple[Any, ...]) -> int:
+        """
+        Вспомогательный метод, добавляющий в таблицу строку values
+        и возвращающий её pk
+        """
+        if INSERT_RETURNING:
+            pk: int = cur.execute(self.queries['add'], values).fetchone()[0]
+            return pk
+        cur.execute(self.queries['add'], values)
+        return cur.lastrowid or 0
+
+    def _values(self, obj: T) -> tuple[Any, ...]:
+        """
+        Вспомогательный метод, возвращающий кортеж значений полей объекта
+        в том виде, в котором они хранятся в базе данных
+        """
+        values = self._getter(obj)
+        if len(self.fields) == 1:
+            values = (values,)
+        if not self._adapters:
+            return values
+        return tuple(self._adapt(name, value) for name, value in zip(self.fields, values))
+
+    def _adapt(self, name: str, value: Any) -> Any:
+        """
+        Вспомогательный метод, приводящий значение поля name
+        к хранимому в базе данных виду
+        """
+        adapt = self._adapters.get(name)
+        return value if adapt is None or value is None else adapt(value)
+
+    def _compile_row_factory(self
+                             ) -> Callable[[sqlite3.Cursor | None, tuple[Any, ...]], T]:
+        """
+        Вспомогательный метод, генерирующий фабрику строк для курсоров,
+        возвращающих объекты класса T. Код фабрики собирается один раз
+        под конкретный класс: значения берутся из строки по индексу,
+        даты уже преобразованы преобразователями sqlite3.
+        """
+        namespace: dict[str, Any] = {'cls': self.cls}
+        arguments = [f'{name}=row[{i}]' for i, name in enumerate(self.fields, 1)]
+        source = (f'def row_factory(_, row):\n'
+                  f'    obj = cls({", ".join(arguments)})\n'
+                  f'    obj.pk = row[0]\n'
+                  f'    return obj\n')
+        exec(source, namespace)  # pylint: disable=exec-used
+        return namespace['row_factory']  # type: ignore
+
+    def _generate_object(self, values: tuple[Any, ...]) -> T:
         """
         Вспомогательный метод для генерации объектов класса T
         из значений, хранящихся в базе даных.
         """
-        class_arguments = {}
-
-        for field_name, field_value in zip(self.fields.keys(), values[1:]):
-            field_type = self.fields[field_name]
-            if field_type == datetime:
-                field_value = datetime.fromisoformat(field_value)
-            if field_type == date:
-                field_value = date.fromisoformat(field_value)
+        return self._row_factory(None, values)
 
-            class_arguments[field_name] = field_value
+    @classmethod
+    def _select_column(cls, name: str, obj_type: type) -> str:
+        """
+        Вспомогательный метод, возвращающий выражение для чтения поля name
+        типа obj_type. Для дат к имени столбца добавляется имя
+        преобразователя sqlite3.
+        """
+        obj_type = cls._unwrap_optional(obj_type)
+        if obj_type is datetime:
+            return f'{name} AS "{name} [bookkeeper_datetime]"'
+        if obj_type is date:
+            return f'{name} AS "{name} [bookkeeper_date]"'
+        return name
 
-        obj = self.cls(**class_arguments)
-        obj.pk = values[0]
-        return obj  # type: ignore
+    @classmethod
+    def _resolve_adapter(cls, obj_type: type) -> Callable[[Any], Any] | None:
+        """
+        Вспомогательный метод, подбирающий функцию преобразования
+        значения питоновского типа obj_type для записи в базу данных
+        """
+        obj_type = cls._unwrap_optional(obj_type)
+        if obj_type is datetime:
+            return _datetime_to_db
+        if obj_type is date:
+            return _date_to_db
+        return None
 
     @staticmethod
-    def _resolve_type(obj_type: type) -> str:
+    def _unwrap_optional(obj_type: type) -> type:
+        """
+        Вспомогательный метод, возвращающий тип X для необязательного
+        поля типа X | None, остальные типы возвращаются без изменений
+        """
+        if get_origin(obj_type) in (UnionType, Union):
+            args = [arg for arg in get_args(obj_type) if arg is not NoneType]
+            if len(args) == 1:
+                return args[0]  # type: ignore
+        return obj_type
+
+    @classmethod
+    def _resolve_type(cls, obj_type: type) -> str:
         """
             Вспомогательный метод для соответствия типов данных
-            питоновских и SQLite
+            питоновских и SQLite. Для необязательных полей (X | None)
+            используется тип X.
         """
-        if issubclass(UnionType, obj_type):
-            obj_type = get_args(obj_type)  # type: ignore
-        if issubclass(str, obj_type):
+        obj_type = cls._unwrap_optional(obj_type)
+        if obj_type is str:
             return 'TEXT'
-        if issubclass(int, obj_type):
+        if obj_type is int:
             return 'INTEGER'
-        if issubclass(float, obj_type):
+        if obj_type is float:
             return 'REAL'
-        if issubclass(datetime, obj_type):
+        if obj_type is datetime:
             return 'TIMESTAMP'
+        if obj_type is date:
+            return 'DATE'
         return 'TEXT'
@@ -9,7 +9,7 @@ from bookkeeper.utils import read_tree
 
 DB_FILE = 'bookkeeper.db'
 
-cat_repo = SQLiteRepository[Category](DB_FILE, Category)
+cat_repo = SQLiteRepository[Category](DB_FILE, Category, indexed_fields=['name'])
 exp_repo = SQLiteRepository[Expense](DB_FILE, Expense)
 
 cats = '''
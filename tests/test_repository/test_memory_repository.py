@@ -69,3 +69,10 @@ def test_get_all_with_condition(repo, custom_class):
         objects.append(o)
     assert repo.get_all({'name': '0'}) == [objects[0]]
     assert repo.get_all({'test': 'test'}) == objects
+
+
+def test_add_many(repo, custom_class):
+    objects = [custom_class() for i in range(5)]
+    pks = repo.add_many(objects)
+    assert pks == [o.pk for o in objects]
+    assert repo.get_all() == objects
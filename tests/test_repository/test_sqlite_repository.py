@@ -1,10 +1,12 @@
 import pytest
 import sqlite3
 from dataclasses import dataclass
-from datetime import datetime, date
+from typing import Optional
+from datetime import datetime, date, timedelta, timezone
+from bookkeeper.repository import sqlite_repository
 from bookkeeper.repository.sqlite_repository import SQLiteRepository
 
-DB_FILE = "bookkeeper_test.db"
+DB_FILE = ":memory:"
 FIELD_INT = 1337
 FILED_STR = "test"
 FIELD_DATETIME = datetime.now().replace(microsecond=0)
@@ -19,20 +21,6 @@ TEST_TABLE_CREATE = '''CREATE TABLE IF NOT EXISTS custom (
 );
 '''
 
-TEST_TABLE_DROP = "DROP TABLE IF EXISTS custom;"
-
-
-@pytest.fixture
-def create_schema():
-    with sqlite3.connect(DB_FILE) as con:
-        cur = con.cursor()
-        cur.execute(TEST_TABLE_DROP)
-
-    with sqlite3.connect(DB_FILE) as con:
-        cur = con.cursor()
-        cur.execute(TEST_TABLE_CREATE)
-    con.close()
-
 
 @pytest.fixture
 def custom_class():
@@ -48,13 +36,22 @@ def custom_class():
 
 
 @pytest.fixture
-def repo(custom_class, create_schema):
-    return SQLiteRepository(db_file=DB_FILE, cls=custom_class)
+def repo(custom_class):
+    repo = SQLiteRepository(db_file=DB_FILE, cls=custom_class)
+    yield repo
+    repo.close()
+
+
+@pytest.fixture
+def file_repo(tmp_path, custom_class):
+    repo = SQLiteRepository(db_file=str(tmp_path / 'test.db'), cls=custom_class)
+    yield repo
+    repo.close()
 
 
 def test__generate_object(repo):
     pk = 1
-    row = (pk, FIELD_INT, FILED_STR, str(FIELD_DATETIME), str(FIELD_DATE))
+    row = (pk, FIELD_INT, FILED_STR, FIELD_DATETIME, FIELD_DATE)
     obj = repo._generate_object(row)
 
     assert obj.pk == pk
@@ -123,19 +120,15 @@ def test_cannot_delete_nonexistent(repo):
 
 def test_get_all(repo, custom_class):
     objs = [custom_class() for _ in range(5)]
-    for obj in objs:
-        repo.add(obj)
+    repo.add_many(objs)
     objs_pk = [obj.pk for obj in objs]
     objs_get_all_pk = [obj.pk for obj in repo.get_all()]
     assert objs_pk == objs_get_all_pk
 
 
 def test_get_all_with_condition(repo, custom_class):
-    objs = []
-    for i in range(5):
-        obj = custom_class(field_int=i)
-        repo.add(obj)
-        objs.append(obj)
+    objs = [custom_class(field_int=i) for i in range(5)]
+    repo.add_many(objs)
     res = repo.get_all({'field_int': 0})
     assert res == [objs[0]]
     assert repo.get_all({'field_str': FILED_STR}) == objs
@@ -147,4 +140,289 @@ def test__resolve_type(repo):
     assert repo._resolve_type(type(1.23)) == 'REAL'
     assert repo._resolve_type(type([])) == 'TEXT'
     assert repo._resolve_type(type(datetime.now())) == 'TIMESTAMP'
-    assert repo._resolve_type(type(int | None)) == 'TEXT'
\ No newline at end of file
+    assert repo._resolve_type(type(int | None)) == 'TEXT'
+    assert repo._resolve_type(int | None) == 'INTEGER'
+    assert repo._resolve_type(Optional[str]) == 'TEXT'
+    assert repo._resolve_type(float | None) == 'REAL'
+    assert repo._resolve_type(date) == 'DATE'
+    assert repo._resolve_type(datetime | None) == 'TIMESTAMP'
+    assert repo._resolve_type(int | str) == 'TEXT'
+    assert repo._resolve_type(bool) == 'TEXT'
+
+
+def test_close(repo, custom_class):
+    repo.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        repo.add(custom_class())
+
+
+def test_close_file_repo(file_repo, custom_class):
+    obj = custom_class()
+    file_repo.add(obj)
+    with file_repo._reader():
+        file_repo.close()
+    assert file_repo._readers.empty()
+    with pytest.raises(sqlite3.ProgrammingError):
+        file_repo.add(custom_class())
+    with pytest.raises(sqlite3.ProgrammingError):
+        file_repo.get(obj.pk)
+    with pytest.raises(sqlite3.ProgrammingError):
+        file_repo.get_all()
+    assert file_repo._readers.empty()
+
+
+def test_wal_journal_mode(file_repo):
+    with file_repo._cursor() as cur:
+        assert cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_where_query_is_cached(repo):
+    query = repo._where_query(('field_int', 'field_str'))
+    assert query.endswith('WHERE field_int = ? AND field_str = ?')
+    assert repo._where_query(('field_int', 'field_str')) is query
+
+
+def test_add_many(repo, custom_class):
+    objs = [custom_class(field_int=i) for i in range(5)]
+    pks = repo.add_many(objs)
+    assert pks == [obj.pk for obj in objs]
+    assert repo.get_all() == objs
+
+
+def test_cannot_add_many_with_filled_pk(repo, custom_class):
+    with pytest.raises(ValueError):
+        repo.add_many([custom_class(), custom_class(pk=1)])
+    assert repo.get_all() == []
+
+
+def test_add_many_is_atomic(repo, custom_class):
+    objs = [custom_class(), custom_class(field_str=[])]
+    with pytest.raises(sqlite3.Error):
+        repo.add_many(objs)
+    assert repo.get_all() == []
+    assert [obj.pk for obj in objs] == [0, 0]
+
+
+def test_get_all_with_condition_in_any_order(repo, custom_class):
+    objs = [custom_class(field_int=i) for i in range(3)]
+    repo.add_many(objs)
+    assert repo.get_all({'field_int': 1, 'field_str': FILED_STR}) == [objs[1]]
+    assert repo.get_all({'field_str': FILED_STR, 'field_int': 1}) == [objs[1]]
+    assert len(repo._where_queries) == 1
+
+
+def test_migrate_text_dates(tmp_path, custom_class):
+    db_file = str(tmp_path / 'old.db')
+    field_datetime = datetime(2023, 3, 1, 12, 30, 15, 123456)
+    with sqlite3.connect(db_file) as con:
+        con.execute(TEST_TABLE_CREATE)
+        con.execute(
+            'INSERT INTO custom (field_int, field_str, field_datetime, field_date) '
+            'VALUES (?, ?, ?, ?)',
+            [FIELD_INT, FILED_STR, str(field_datetime), str(FIELD_DATE)])
+        con.execute(
+            'INSERT INTO custom (field_int, field_str, field_datetime, field_date) '
+            'VALUES (?, ?, ?, ?)',
+            [FIELD_INT, FILED_STR, str(FIELD_DATETIME), str(FIELD_DATE)])
+    con.close()
+    repo = SQLiteRepository(db_file=db_file, cls=custom_class)
+    assert [(obj.field_datetime, obj.field_date) for obj in repo.get_all()] == [
+        (field_datetime, FIELD_DATE), (FIELD_DATETIME, FIELD_DATE)]
+    repo.close()
+
+
+def test_migration_runs_once_on_text_columns(tmp_path, custom_class):
+    db_file = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_file) as con:
+        con.execute(TEST_TABLE_CREATE)
+        con.execute(
+            'INSERT INTO custom (field_int, field_str, field_datetime, field_date) '
+            'VALUES (?, ?, ?, ?)',
+            [FIELD_INT, FILED_STR, str(FIELD_DATETIME), str(FIELD_DATE)])
+    con.close()
+    for _ in range(2):
+        sqlite_repository._ENSURED.clear()
+        repo = SQLiteRepository(db_file=db_file, cls=custom_class)
+        assert [(obj.field_datetime, obj.field_date) for obj in repo.get_all()] == [
+            (FIELD_DATETIME, FIELD_DATE)]
+        repo.close()
+
+
+def test_migrate_text_dates_with_offset(tmp_path, custom_class):
+    db_file = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_file) as con:
+        con.execute(TEST_TABLE_CREATE)
+        con.executemany(
+            'INSERT INTO custom (field_int, field_str, field_datetime, field_date) '
+            'VALUES (?, ?, ?, ?)',
+            [(FIELD_INT, FILED_STR, text, str(FIELD_DATE)) for text in (
+                '2020-01-01T10:00:00+03:00',
+                '2020-01-01T10:00:00.25-01:00',
+                '2020-01-01T10:00:00.5Z')])
+    con.close()
+    repo = SQLiteRepository(db_file=db_file, cls=custom_class)
+    assert [obj.field_datetime for obj in repo.get_all()] == [
+        datetime(2020, 1, 1, 7), datetime(2020, 1, 1, 11, 0, 0, 250000),
+        datetime(2020, 1, 1, 10, 0, 0, 500000)]
+    repo.close()
+
+
+def test_migration_keeps_unparseable_text(tmp_path, custom_class):
+    db_file = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_file) as con:
+        con.execute(TEST_TABLE_CREATE)
+        con.execute(
+            'INSERT INTO custom (field_int, field_str, field_datetime, field_date) '
+            'VALUES (?, ?, ?, ?)',
+            [FIELD_INT, FILED_STR, 'not a datetime', 'not a date'])
+    con.close()
+    SQLiteRepository(db_file=db_file, cls=custom_class).close()
+    with sqlite3.connect(db_file) as con:
+        assert con.execute('SELECT field_datetime, field_date FROM custom'
+                           ).fetchall() == [('not a datetime', 'not a date')]
+    con.close()
+
+
+def test_aware_datetime(repo, custom_class):
+    aware = datetime(2020, 1, 1, 10, tzinfo=timezone(timedelta(hours=3)))
+    obj = custom_class(field_datetime=aware)
+    repo.add(obj)
+    assert repo.get(obj.pk).field_datetime == datetime(2020, 1, 1, 7)
+
+
+def test_single_field_class(tmp_path):
+    @dataclass
+    class Single:
+        name: str = ''
+        pk: int = 0
+
+    repo = SQLiteRepository(db_file=str(tmp_path / 'single.db'), cls=Single)
+    obj = Single('test')
+    repo.add(obj)
+    obj.name = 'new'
+    repo.update(obj)
+    assert repo.get_all() == [obj]
+    repo.close()
+
+
+def test_get_all_several_batches(repo, custom_class):
+    objs = [custom_class(field_int=i) for i in range(2500)]
+    repo.add_many(objs)
+    assert repo.get_all() == objs
+
+
+def test_foreign_keys_enabled(repo):
+    with repo._cursor() as cur:
+        assert cur.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+
+
+def test_reads_use_read_only_pool(file_repo, custom_class):
+    obj = custom_class()
+    file_repo.add(obj)
+    assert file_repo.get(obj.pk) == obj
+    assert file_repo._readers.qsize() == 1
+    with file_repo._reader() as cur:
+        with pytest.raises(sqlite3.OperationalError):
+            cur.execute(file_repo.queries['delete'], [obj.pk])
+    assert file_repo.get_all() == [obj]
+
+
+def test_memory_db_reads_through_writer(repo, custom_class):
+    obj = custom_class()
+    repo.add(obj)
+    assert repo.get(obj.pk) == obj
+    assert repo.get_all() == [obj]
+    assert repo._readers.empty()
+
+
+def test_ensure_schema_once(tmp_path, custom_class, monkeypatch):
+    db_file = str(tmp_path / 'schema.db')
+    SQLiteRepository.ensure_schema(db_file, custom_class)
+    with sqlite3.connect(db_file) as con:
+        assert con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"
+                           ).fetchall() == [('custom',)]
+    con.close()
+
+    def fail(_):
+        raise AssertionError('schema created twice')
+    monkeypatch.setattr(SQLiteRepository, '_create_schema', fail)
+    repo = SQLiteRepository(db_file=db_file, cls=custom_class)
+    repo.close()
+
+
+def test_optional_datetime():
+    @dataclass
+    class Event:
+        start: datetime | None = None
+        pk: int = 0
+
+    repo = SQLiteRepository(db_file=DB_FILE, cls=Event)
+    events = [Event(), Event(FIELD_DATETIME)]
+    repo.add_many(events)
+    assert repo.get_all() == events
+    assert repo.get_all({'start': FIELD_DATETIME}) == [events[1]]
+    repo.close()
+
+
+def test_indexed_fields(custom_class, caplog):
+    repo = SQLiteRepository(db_file=DB_FILE, cls=custom_class,
+                            indexed_fields=['field_int'])
+    with repo._cursor() as cur:
+        plan = cur.execute('EXPLAIN QUERY PLAN ' + repo._where_query(('field_int',)),
+                           (0,)).fetchall()
+    assert 'idx_custom_field_int' in str(plan)
+    assert not caplog.records
+    repo.get_all({'field_str': FILED_STR})
+    assert 'field_str' in caplog.text
+    repo.close()
+
+
+def test_cannot_index_unknown_field(custom_class):
+    with pytest.raises(ValueError):
+        SQLiteRepository(db_file=DB_FILE, cls=custom_class, indexed_fields=['unknown'])
+
+
+def test_new_db_page_size(file_repo):
+    with file_repo._cursor() as cur:
+        assert cur.execute('PRAGMA page_size').fetchone()[0] == 8192
+
+
+def test_other_connections_keep_default_adapters(repo):
+    con = sqlite3.connect(':memory:')
+    assert con.execute('SELECT typeof(?)', (datetime(2020, 1, 1),)).fetchone() == ('text',)
+    con.close()
+
+
+def test_failed_schema_is_rolled_back(tmp_path, custom_class):
+    db_file = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_file) as con:
+        con.execute('CREATE TABLE custom (field_int int, pk INTEGER PRIMARY KEY)')
+        con.execute("INSERT INTO custom (field_int) VALUES ('1')")
+    con.close()
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteRepository(db_file=db_file, cls=custom_class,
+                         indexed_fields=['field_int', 'field_str'])
+    with sqlite3.connect(db_file) as con:
+        assert con.execute("SELECT name FROM sqlite_master WHERE type = 'index'"
+                           ).fetchall() == []
+    con.close()
+
+
+def test_failed_schema_leaves_no_transaction(repo):
+    repo.indexed_fields = ('unknown',)
+    with pytest.raises(sqlite3.OperationalError):
+        repo._create_schema()
+    assert not repo._con.in_transaction
+
+
+def test_relative_path_survives_chdir(tmp_path, custom_class, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    repo = SQLiteRepository(db_file='data/test.db', cls=custom_class)
+    monkeypatch.chdir(tmp_path / 'data')
+    obj = custom_class()
+    repo.add(obj)
+    assert repo.get(obj.pk) == obj
+    assert repo.get_all() == [obj]
+    assert not (tmp_path / 'data' / 'data').exists()
+    repo.close()